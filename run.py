@@ -1,52 +1,114 @@
+import os
+# This must be set before datasets/transformers are imported. The .map() workers are separate
+# processes, so keep each fast tokenizer single-threaded instead of forking its Rust thread pool.
+os.environ.setdefault('TOKENIZERS_PARALLELISM', 'false')
+
 import datasets
+import torch
 from transformers import AutoTokenizer, AutoModelForSequenceClassification, \
     AutoModelForQuestionAnswering, Trainer, TrainingArguments, HfArgumentParser
+from transformers.file_utils import is_torch_bf16_available
 from helpers import prepare_dataset_nli, prepare_train_dataset_qa, \
     prepare_validation_dataset_qa, QuestionAnsweringTrainer, compute_accuracy
-import os
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import hashlib
+import inspect
 import json
-from scipy.special import softmax  
+import re
+import sys
+import numpy as np
 import pandas as pd 
-from tqdm import tqdm 
+import pyarrow.compute as pc
+
+FEATURIZED_CACHE_DIR = '.hf_cache'
+TRAIN_DY_METRICS_PATH = 'resources/full.pkl'
 
-NUM_PREPROCESSING_WORKERS = 4
+# Whether sorting by each metric in ascending order yields the most `valuable` examples first.
+_ASCENDING_METRICS = {
+  "variability": False,
+  "confidence": True,
+  "threshold_closeness": False,
+  "forgetfulness": False,
+  "correctness": True,
+}
 
 def consider_ascending_order(filtering_metric: str) -> bool:
   """
   Determine if the metric values' sorting order to get the most `valuable` examples for training.
   """
-  if filtering_metric == "variability":
-    return False
-  elif filtering_metric == "confidence":
-    return True
-  elif filtering_metric == "threshold_closeness":
-    return False
-  elif filtering_metric == "forgetfulness":
-    return False
-  elif filtering_metric == "correctness":
-    return True
-  else:
+  try:
+    return _ASCENDING_METRICS[filtering_metric]
+  except KeyError:
     raise NotImplementedError(f"Filtering based on {filtering_metric} not implemented!")
 
-def subsample_dataset(args, train_dy_metrics, dataset):
+def load_train_dy_metrics(metric: str) -> pd.DataFrame:
+    """
+    Load only the `guid` and `metric` columns of the training dynamics.
+    The pickle is converted to Parquet (again whenever the pickle is regenerated) so loads can skip the unused columns.
+    """
+    parquet_path = os.path.splitext(TRAIN_DY_METRICS_PATH)[0] + '.parquet'
+    if not os.path.exists(parquet_path) or \
+            os.path.getmtime(TRAIN_DY_METRICS_PATH) > os.path.getmtime(parquet_path):
+        # Write to a temporary file first so an interrupted or concurrent run never leaves a truncated Parquet file
+        tmp_path = f'{parquet_path}.{os.getpid()}.tmp'
+        pd.read_pickle(TRAIN_DY_METRICS_PATH).to_parquet(tmp_path)
+        os.replace(tmp_path, parquet_path)
+    return pd.read_parquet(parquet_path, columns=['guid', metric])
+
+def top_k_guids(metric_values: np.ndarray, guids: np.ndarray, k: int, ascending: bool) -> np.ndarray:
+    """
+    Return the guids of the `k` examples that come first when sorting by metric value, in that order.
+    Only the top `k` rows are kept, so a partial sort (argpartition) is enough before ordering them.
+    """
+    keys = metric_values if ascending else -metric_values
+    top = np.argpartition(keys, k)[:k] if k < len(keys) else np.arange(len(keys))
+    top = top[np.argsort(keys[top], kind='stable')]
+    return guids[top]
+
+def subsample_dataset(args, train_dy_metrics, dataset, max_samples=None):
     is_ascending = consider_ascending_order(args.metric)
     if args.worst:
         is_ascending = not is_ascending
 
-    sorted_scores = train_dy_metrics.sort_values(by=[args.metric],
-                                                ascending=is_ascending)
-
     num_samples = int(0.3319 * len(dataset))
-    selected = sorted_scores.head(n=num_samples+1)
-
-    indices = [] 
-
-    for idx in tqdm(range(num_samples)):
-        indices.append(int(selected.iloc[idx]["guid"]))
-
-    sub_dataset = dataset.select(indices)
+    indices = top_k_guids(train_dy_metrics[args.metric].to_numpy(),
+                          train_dy_metrics["guid"].to_numpy(dtype=np.int64),
+                          num_samples, is_ascending)
+    # Truncate here so that --max_*_samples does not need a second .select() on the subset
+    if max_samples:
+        indices = indices[:max_samples]
+
+    # Passing the int64 array straight through avoids boxing every index into a Python int
+    sub_dataset = dataset.select(indices, keep_in_memory=True)
     return sub_dataset 
 
+def restrict_to_columns(dataset, columns):
+    """
+    Drop every column not in `columns`, so .map() only converts the fields the preprocessing function reads.
+    """
+    return dataset.remove_columns([c for c in dataset.column_names if c not in columns])
+
+def featurized_cache_file(args, dataset, prepare_fn, split: str) -> str:
+    """
+    Cache path for a featurized split, so repeated runs reuse the tokenized data.
+    The key covers the input dataset's content fingerprint (source files, subset indices), the tokenizer's
+    serialized state and the source of the module defining the preprocessing function,
+    so a change to any of them invalidates the cache.
+    """
+    tokenizer = prepare_fn.keywords['tokenizer']
+    if tokenizer.is_fast:
+        tokenizer_state = tokenizer.backend_tokenizer.to_str()
+    else:
+        # Slow tokenizers have no serialized backend; their vocab and settings identify them instead
+        tokenizer_state = json.dumps([sorted(tokenizer.get_vocab().items()), tokenizer.init_kwargs],
+                                     sort_keys=True, default=str)
+    prepare_source = inspect.getsource(inspect.getmodule(prepare_fn.func))
+    key = '|'.join(str(v) for v in (args.task, args.max_length, split, dataset._fingerprint,
+                                    tokenizer_state, prepare_source))
+    key = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return os.path.join(FEATURIZED_CACHE_DIR, f'{split}_{key}.arrow')
+
 def main():
     argp = HfArgumentParser(TrainingArguments)
     # The HfArgumentParser object collects command-line arguments into an object (and provides default values for unspecified arguments).
@@ -84,7 +146,14 @@ def main():
                       help='Limit the number of examples to train on.')
     argp.add_argument('--max_eval_samples', type=int, default=None,
                       help='Limit the number of examples to evaluate on.')
+    argp.add_argument('--preprocessing_num_workers', type=int, default=min(os.cpu_count() or 4, 16),
+                      help='Number of processes used to tokenize the datasets.')
+    argp.add_argument('--no_torch_compile', action='store_true',
+                      help='Disable torch.compile of the model when training/evaluating on GPU.')
     argp.add_argument("--eval_train", action='store_true')
+    argp.add_argument('--dump_training_dynamics', action='store_true',
+                      help="""With --eval_train on an NLI checkpoint-<step> model, write per-example class probabilities
+        on the full train split to <output_dir>/training_dynamics, in the format read by third_party/cartography.""")
     argp.add_argument("--subset", action='store_true')
     argp.add_argument("--worst",
                       action="store_true",
@@ -100,13 +169,55 @@ def main():
                       help="Metric to filter data by.",)
 
 
+    # Defaults for TrainingArguments are set on the parser, so explicit command-line values still win
+    # and TrainingArguments.__post_init__ runs exactly once on the final values
+    def flag_passed(flag):
+        return any(arg == flag or arg.startswith(flag + '=') for arg in sys.argv[1:])
+    # --no_cuda was renamed to --use_cpu in newer transformers releases
+    use_gpu = torch.cuda.is_available() and not (flag_passed('--no_cuda') or flag_passed('--use_cpu'))
+
+    # Collate batches in background workers so they overlap with compute (memory is pinned by default)
+    argp.set_defaults(dataloader_num_workers=min(4, os.cpu_count() or 1))
+    # dataloader_prefetch_factor only exists in newer transformers releases, and requires workers > 0,
+    # which only the default worker count above guarantees
+    if hasattr(TrainingArguments, 'dataloader_prefetch_factor') and not flag_passed('--dataloader_num_workers'):
+        argp.set_defaults(dataloader_prefetch_factor=4)
+
+    # Train/evaluate in mixed precision on GPU unless a precision was requested explicitly
+    if use_gpu and not (flag_passed('--fp16') or flag_passed('--bf16')):
+        if is_torch_bf16_available():
+            argp.set_defaults(bf16=True)
+        else:
+            argp.set_defaults(fp16=True)
+
+    # Fuse kernels with TorchInductor on GPU; torch_compile only exists in newer transformers releases,
+    # and compiling the model by hand would change the state dict keys of the saved checkpoints
+    if use_gpu and not flag_passed('--no_torch_compile') and hasattr(TrainingArguments, 'torch_compile'):
+        argp.set_defaults(torch_compile=True, torch_compile_backend='inductor',
+                          torch_compile_mode='reduce-overhead')
+
     training_args, args = argp.parse_args_into_dataclasses()
 
+    # The dynamics dump identifies examples by their position in the full train split
+    dynamics_epoch = None
+    if args.dump_training_dynamics:
+        if not (training_args.do_eval and args.eval_train and args.task == 'nli') \
+                or args.subset or args.max_eval_samples:
+            argp.error('--dump_training_dynamics needs --do_eval --eval_train --task nli, '
+                       'without --subset or --max_eval_samples')
+        # Checkpoints are saved every 1500 steps (one epoch)
+        step = re.search(r'checkpoint-(\d+)', str(args.model))
+        if step is None:
+            print(f'Warning: --model {args.model} is not a checkpoint-<step> folder, '
+                  'so training dynamics will not be dumped')
+        else:
+            dynamics_epoch = int(step.group(1)) // 1500 - 1
+
     # Dataset selection
     if args.dataset.endswith('.json') or args.dataset.endswith('.jsonl'):
         dataset_id = None
         # Load from local json/jsonl file
-        dataset = datasets.load_dataset('json', data_files=args.dataset)
+        dataset_args, dataset_kwargs = ('json',), {'data_files': args.dataset}
         # By default, the "json" dataset loader places all examples in the train split,
         # so if we want to use a jsonl file for evaluation we need to get the "train" split
         # from the loaded dataset
@@ -117,9 +228,7 @@ def main():
             default_datasets[args.task]
         # MNLI has two validation splits (one with matched domains and one with mismatched domains). Most datasets just have one "validation" split
         eval_split = 'validation_matched' if dataset_id == ('glue', 'mnli') else 'validation'
-        # Load the raw data
-
-        dataset = datasets.load_dataset(*dataset_id)
+        dataset_args, dataset_kwargs = dataset_id, {}
     
     # NLI models need to have the output label count specified (label 0 is "entailed", 1 is "neutral", and 2 is "contradiction")
     task_kwargs = {'num_labels': 3} if args.task == 'nli' else {}
@@ -129,72 +238,95 @@ def main():
                      'nli': AutoModelForSequenceClassification}
     model_class = model_classes[args.task]
 
-    # Initialize the model and tokenizer from the specified pretrained model/checkpoint
-    model = model_class.from_pretrained(args.model, **task_kwargs)
-    tokenizer = AutoTokenizer.from_pretrained(args.model, use_fast=True)
+    # Load the raw data and initialize the model and tokenizer from the specified pretrained model/checkpoint.
+    # These are independent and mostly IO-bound (downloads, disk reads), so they run concurrently.
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        dataset_future = executor.submit(datasets.load_dataset, *dataset_args, **dataset_kwargs)
+        model_future = executor.submit(model_class.from_pretrained, args.model, **task_kwargs)
+        tokenizer_future = executor.submit(AutoTokenizer.from_pretrained, args.model, use_fast=True)
+        dataset = dataset_future.result()
+        model = model_future.result()
+        tokenizer = tokenizer_future.result()
 
     # Select the dataset preprocessing function (these functions are defined in helpers.py)
     if args.task == 'qa':
-        prepare_train_dataset = lambda exs: prepare_train_dataset_qa(exs, tokenizer)
-        prepare_eval_dataset = lambda exs: prepare_validation_dataset_qa(exs, tokenizer)
+        # functools.partial (unlike a lambda) gives datasets a stable fingerprint to cache on
+        prepare_train_dataset = functools.partial(prepare_train_dataset_qa, tokenizer=tokenizer)
+        prepare_eval_dataset = functools.partial(prepare_validation_dataset_qa, tokenizer=tokenizer)
+        train_input_columns = ['question', 'context', 'answers']
+        eval_input_columns = ['id', 'question', 'context']
     elif args.task == 'nli':
-        prepare_train_dataset = prepare_eval_dataset = \
-            lambda exs: prepare_dataset_nli(exs, tokenizer, args.max_length)
+        prepare_train_dataset = prepare_eval_dataset = functools.partial(
+            prepare_dataset_nli, tokenizer=tokenizer, max_seq_length=args.max_length)
+        train_input_columns = eval_input_columns = ['premise', 'hypothesis', 'label']
         # prepare_eval_dataset = prepare_dataset_nli
     else:
         raise ValueError('Unrecognized task name: {}'.format(args.task))
 
     print("Preprocessing data... (this takes a little bit, should only happen once per dataset)")
     if dataset_id == ('snli',):
-        # remove SNLI examples with no label
-        dataset = dataset.filter(lambda ex: ex['label'] != -1)
+        # remove SNLI examples with no label. The mask is computed on the Arrow column without a per-row
+        # callback, and .select() keeps the splits memory-mapped so .map() workers don't each pickle a copy.
+        for split, split_dataset in dataset.items():
+            labeled = pc.not_equal(split_dataset.data.table['label'], -1)
+            dataset[split] = split_dataset.select(np.flatnonzero(np.asarray(labeled)))
     
+    os.makedirs(FEATURIZED_CACHE_DIR, exist_ok=True)
+
     train_dataset = None
     eval_dataset = None
     train_dataset_featurized = None
     eval_dataset_featurized = None
+    # Training dynamics are shared by the train and eval subsets, so only load them once
+    train_dy_metrics = load_train_dy_metrics(args.metric) if args.subset else None
     if training_args.do_train:
         train_dataset = dataset['train']
         if args.subset:
-            train_dy_metrics = pd.read_pickle('resources/full.pkl')
-            train_dataset = subsample_dataset(args, train_dy_metrics, train_dataset)
-
-        if args.max_train_samples:
+            train_dataset = subsample_dataset(args, train_dy_metrics, train_dataset,
+                                              max_samples=args.max_train_samples)
+        elif args.max_train_samples:
             train_dataset = train_dataset.select(range(args.max_train_samples))
 
-        train_dataset_featurized = train_dataset.map(
+        train_dataset_input = restrict_to_columns(train_dataset, train_input_columns)
+        train_dataset_featurized = train_dataset_input.map(
             prepare_train_dataset,
             batched=True,
-            num_proc=NUM_PREPROCESSING_WORKERS,
-            remove_columns=train_dataset.column_names
+            # datasets 2.0.0 does not clamp num_proc, and empty shards break their concatenation
+            num_proc=max(1, min(args.preprocessing_num_workers, len(train_dataset_input))),
+            remove_columns=train_dataset_input.column_names,
+            load_from_cache_file=True,
+            cache_file_name=featurized_cache_file(args, train_dataset_input, prepare_train_dataset, 'train')
         )
     if training_args.do_eval:
         if args.eval_train:
             eval_dataset = dataset['train']
             prepare_dataset = prepare_train_dataset
+            input_columns = train_input_columns
         else:
             eval_dataset = dataset[eval_split]
             prepare_dataset = prepare_eval_dataset
+            input_columns = eval_input_columns
 
         if args.subset:
-            train_dy_metrics = pd.read_pickle('resources/full.pkl')
-            eval_dataset = subsample_dataset(args, train_dy_metrics, eval_dataset)
-
-
-        import pdb; pdb.set_trace()
-
-        if args.max_eval_samples:
+            eval_dataset = subsample_dataset(args, train_dy_metrics, eval_dataset,
+                                             max_samples=args.max_eval_samples)
+        elif args.max_eval_samples:
             eval_dataset = eval_dataset.select(range(args.max_eval_samples))
 
-        is_ascending = consider_ascending_order(args.metric)
-        if args.worst:
-            is_ascending = not is_ascending
+        if os.environ.get('NLP_DEBUG'):
+            breakpoint()
 
-        eval_dataset_featurized = eval_dataset.map(
+        # eval_dataset itself keeps every column, since QA post-processing and the dynamics dump read them
+        eval_dataset_input = restrict_to_columns(eval_dataset, input_columns)
+        eval_dataset_featurized = eval_dataset_input.map(
             prepare_dataset,
             batched=True,
-            num_proc=NUM_PREPROCESSING_WORKERS,
-            remove_columns=eval_dataset.column_names
+            # datasets 2.0.0 does not clamp num_proc, and empty shards break their concatenation
+            num_proc=max(1, min(args.preprocessing_num_workers, len(eval_dataset_input))),
+            remove_columns=eval_dataset_input.column_names,
+            load_from_cache_file=True,
+            cache_file_name=featurized_cache_file(args, eval_dataset_input, prepare_dataset,
+                                                  'eval_train' if args.eval_train else eval_split)
         )
 
 
@@ -209,7 +341,12 @@ def main():
         # to enable the question-answering specific evaluation metrics
         trainer_class = QuestionAnsweringTrainer
         eval_kwargs['eval_examples'] = eval_dataset
-        metric = datasets.load_metric('squad')
+        # Only QA runs need the SQuAD metric; prefer evaluate, which caches the loaded module
+        try:
+            import evaluate
+            metric = evaluate.load('squad')
+        except ImportError:
+            metric = datasets.load_metric('squad', keep_in_memory=True)
         compute_metrics = lambda eval_preds: metric.compute(
             predictions=eval_preds.predictions, references=eval_preds.label_ids)
     elif args.task == 'nli':
@@ -243,27 +380,26 @@ def main():
         print(f'Evaluation results: {args.model}')
         print(results)
 
-        idx = int(str(args.model).split('-')[-1]) // 1500 - 1
-
-        # os.makedirs(training_args.output_dir+'/training_dynamics', exist_ok=True)
-
-        """with open(os.path.join(training_args.output_dir, 'training_dynamics',
-            f'dynamics_epoch_{idx}.jsonl'), encoding='utf-8', mode='w') as f:
-
-            for i, example in enumerate(eval_dataset):
-                example_with_prediction = dict(example)
-                # example_with_prediction['predicted_scores'] = eval_predictions.predictions[i].tolist()
-                # example_with_prediction['predicted_label'] = int(eval_predictions.predictions[i].argmax())
-
-                example_with_prediction['guid']= i 
-                example_with_prediction[f'logits_epoch_{idx}'] = softmax(eval_predictions.predictions[i]).tolist()
-                example_with_prediction['gold'] = example_with_prediction['label']
-                example_with_prediction.pop('premise')
-                example_with_prediction.pop('hypothesis')
-
-                f.write(json.dumps(example_with_prediction))
-                f.write('\n')
-        """
+        if dynamics_epoch is not None:
+            # Dump per-example class probabilities on the train split, in the training dynamics
+            # format read by third_party/cartography
+            os.makedirs(os.path.join(training_args.output_dir, 'training_dynamics'), exist_ok=True)
+
+            # Softmax over the whole (N, C) logits array at once rather than per example
+            logits = eval_predictions.predictions
+            probs = np.exp(logits - logits.max(axis=-1, keepdims=True))
+            probs = (probs / probs.sum(axis=-1, keepdims=True)).tolist()
+
+            with open(os.path.join(training_args.output_dir, 'training_dynamics',
+                f'dynamics_epoch_{dynamics_epoch}.jsonl'), encoding='utf-8', mode='w') as f:
+                for i, example in enumerate(eval_dataset.remove_columns(['premise', 'hypothesis'])):
+                    example_with_prediction = dict(example)
+                    example_with_prediction['guid'] = i
+                    example_with_prediction[f'logits_epoch_{dynamics_epoch}'] = probs[i]
+                    example_with_prediction['gold'] = example_with_prediction['label']
+
+                    f.write(json.dumps(example_with_prediction))
+                    f.write('\n')
 
 if __name__ == "__main__":
     main()